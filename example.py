@@ -64,6 +64,10 @@ analyze("Cheeseburgers")
 analyze("Cheeseburgers")
 analyze("Cheeseburgers")
 
+# For longer lists, pass a batch template and all items get asked concurrently. {lambda} is the list item.
+for is_vegan in AI("ingredients of Pizza", batch=AI("is {lambda} vegan?", output=bool)):
+	print(is_vegan)
+
 
 # You can also request dictionaries:
 ferrari = AI("Detailed exact properties of a Ferrari model 458, incl. 'brand', 'engine', 'power', 'speed'", output=dict)
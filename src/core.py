@@ -1,21 +1,23 @@
 import os
 import re
-import openai
+import time
+import asyncio
+import hashlib
+import functools
+import importlib.util
+import sqlite3
+import threading
+import collections
+import concurrent.futures
+import weakref
 import json
 import sys
-from copy import deepcopy
-from langchain_openai import ChatOpenAI, OpenAI
-from langchain.prompts import ChatPromptTemplate, PromptTemplate
-from langchain.chains import LLMChain, SequentialChain
-from langchain.output_parsers import PydanticOutputParser, OutputFixingParser
-from langchain.schema import BaseOutputParser, OutputParserException
-from langchain.schema.output_parser import StrOutputParser
-from langchain.output_parsers.openai_functions import JsonOutputFunctionsParser
-from langchain.schema.runnable import RunnableMap, RunnablePassthrough, RunnableParallel, RunnableBranch
-from langchain_community.utilities.dalle_image_generator import DallEAPIWrapper
-from pydantic import BaseModel, Field, validator, ValidationError
-from typing import List
-from openai import OpenAI
+import httpx
+# langchain_openai and openai take long to import, so they are only imported on first use (see _get_llm and generate_image)
+from langchain_core.prompts import ChatPromptTemplate, PromptTemplate
+from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
+from langchain_core.output_parsers import StrOutputParser, JsonOutputParser
+from langchain_core.output_parsers.openai_functions import JsonOutputFunctionsParser
 
 # an AI class that takes in the following optional parameters:
 # As soon as there is a prompt, the AI will be invoked and the result will be returned
@@ -39,6 +41,35 @@ NUMERICALS_DEFAULT_WITHOUT_FLOAT = False # Enabling this would prefer whole numb
 AUTO_INVOKE_ON_CREATION = False # Enabling this would deactivate the smart type casting it's doing
 AUTO_CAST_TO_PREFERRED_TYPE = True # Forces results to be the type you specified in the output parameter
 
+MAX_CONCURRENT_REQUESTS = 20 # How many requests AI.map() keeps in flight at the same time
+MAX_REQUESTS_PER_MINUTE = 3500 # Rate limits for AI.map(), adjust them to your OpenAI account tier
+MAX_TOKENS_PER_MINUTE = 90000
+MAP_BATCH_SIZE = 25 # How many list items AI.map() packs into a single request, gains flatten out beyond ~50
+PACKABLE_OUTPUT_TYPES = [str, int, float, bool, list] # Output types that can be answered for several items in one request
+PACKED_ITEM_PLACEHOLDER = "<item>"
+MODELS_WITHOUT_JSON_MODE = [
+	"gpt-4", "gpt-4-0314", "gpt-4-0613", "gpt-4-32k", "gpt-4-32k-0314", "gpt-4-32k-0613",
+	"gpt-3.5-turbo-0301", "gpt-3.5-turbo-0613", "gpt-3.5-turbo-16k", "gpt-3.5-turbo-16k-0613",
+] # These get dict outputs through a function call instead
+DICT_OUTPUT_INSTRUCTION = "Respond only with a flat JSON object that defines its own list of properties." # JSON mode needs the word JSON in the messages
+NUMBER_OUTPUT_INSTRUCTION = "Reply with only the number, written out in digits without words like million, no units, no explanation."
+INT_OUTPUT_INSTRUCTION = "Reply with only a whole number, written out in digits without words like million, no units, no explanation."
+BOOL_OUTPUT_INSTRUCTION = "Reply with only 'yes' or 'no'."
+NUMBER_PATTERN = re.compile(r'-?(?:\d+(?:\.\d+)?|\.\d+)(?:[eE][-+]?\d+)?') # First number in a plain text answer
+THOUSANDS_SEPARATOR_PATTERN = re.compile(r'(?<=\d),(?=\d{3}\b)') # As in 11,600,000
+DECIMAL_COMMA_PATTERN = re.compile(r'(?<=\d),(?=\d)') # As in 1,5, checked after the thousands separators are removed
+PLACEHOLDER_PATTERN = re.compile(r'\{([^{}]+?)\}') # {placeholders} in prompts, filled from params
+MISSING_RESPONSE = object() # Marks items a packed request did not return an answer for
+CACHE_MISS = object() # Returned by cache lookups when nothing is cached, as False or 0 can be legitimate cached results
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=32, max_connections=64) # Connection pool shared by all OpenAI requests
+HTTP2_AVAILABLE = importlib.util.find_spec('h2') is not None # HTTP/2 multiplexing needs the optional h2 package (pip install httpx[http2])
+SESSION_CACHE_MAXSIZE = int(os.getenv('AI_SESSION_CACHE_MAXSIZE', 10000)) # Max. number of answers kept in the session cache
+DISK_CACHE_FILENAME = ".ai_cache.sqlite" # File used by the project and module cache locations
+SEMANTIC_CACHE_MODEL = "sentence-transformers/all-MiniLM-L6-v2" # Local embedding model for the semantic cache
+SEMANTIC_CACHE_SIMILARITY = 0.95 # Minimum cosine similarity for two prompts to count as the same question
+SEMANTIC_CACHE_BLOCK_SIZE = 1024 # Initial number of embedding rows of the semantic cache, doubled whenever it is full
+SEMANTIC_CACHE_MAX_TEMPERATURE = 0.3 # Above this temperature, answers are expected to vary, so only exact prompts are matched
+
 VALID_PROVIDERS = ["openai"]
 VALID_CACHE_LOCATIONS = [
 	"none", # No caching at all, even if caching is True
@@ -46,9 +77,14 @@ VALID_CACHE_LOCATIONS = [
 	"session", # Caches for a session, so for the module import (global variable in this module)
 	"project", # Caches for a project, to be stored in the folder where the script is executed
 	"module", # Caches for this module in the python cache folder
+	"semantic", # Caches for a session, but also matches paraphrased prompts via local embeddings (needs sentence-transformers and numpy)
 ] # Anything else will be interpreted as a filesystem path
 # You may point a file system path to the cloud so you can share the cache between multiple instances
 
+disk_caches = {} # Open sqlite connections of the disk caches, by resolved file path
+semantic_cache = None # The SemanticCache of this session, created on first use
+cache_lock = threading.Lock() # Guards the session cache, which is shared between threads
+
 class AI:
 	def __init__(self,
 		prompt:str=None,
@@ -88,8 +124,10 @@ class AI:
 			'numericals_default_to_int': numericals_default_to_int, # Whether to assume that numerical invocations should be cast to int instead of float (so whether the AI has the option to add decimal points to numerical requests)
 			# Notice that this is just the default behavior for unspecified output types. You can always specifc the desired output type when creating an instance or invoking a prompt.
 		}
-		self.results = [] # Structure: [({input_params}, "output"), ({input_params}, "output"), ...]
+		self.results = {} # Structure: {cache key of the invocation settings: "output", ...}
 		self.chat = []
+		self.history = "" # The chat formatted as text, grown with every answer instead of being rebuilt from self.chat
+		self.history_messages = [] # The same chat as langchain messages
 
 		# Checking providers
 		if provider.lower() not in VALID_PROVIDERS:
@@ -116,16 +154,16 @@ class AI:
 	# Returns the URL of the generated image
 	def generate_image(self, prompt, raw=False):
 		if not raw:
-			llm = ChatOpenAI(temperature=self.variables['temperature'], model=self.variables['model'])
+			llm = _get_llm(self.variables['model'], self.variables['temperature'])
 			img_prompt = PromptTemplate(
 				input_variables=["image_desc"],
 				template="Generate a detailed, concise and information-dense prompt of max. 800 characters to generate an image based on the following description: {image_desc}",
 			)
-			ai_chain = LLMChain(llm=llm, prompt=img_prompt) | (lambda x: x['text'])
-			prompt = ai_chain.invoke(prompt)
+			ai_chain = img_prompt | llm | StrOutputParser()
+			prompt = ai_chain.invoke({'image_desc': prompt})
 		
-		# url = DallEAPIWrapper().run(prompt)
-		client = OpenAI()
+		from openai import OpenAI
+		client = OpenAI(http_client=_get_http_client())
 		response = client.images.generate(
 			model="dall-e-3",
 			prompt=prompt,
@@ -138,6 +176,48 @@ class AI:
 
 	# Invoking and executing the actual AI call. That's what we're here for, that's the heavy lifting.
 	def invoke(self, prompt:str=None, **kwargs):
+		kwargs, prompt, prompt_args, full_prompt, output = self._prepare_invocation(prompt, kwargs)
+
+		# Caching
+		cached_result = self._cached_result(kwargs, full_prompt, output)
+		if cached_result is not CACHE_MISS:
+			return cached_result
+
+		image_generation, raw = image_output_mode(output)
+		if image_generation:
+			result = self.generate_image(prompt, raw)
+		else:
+			ai_chain = self._build_chain(prompt, full_prompt, output, kwargs)
+			result = ai_chain.invoke(prompt_args, {'tags': kwargs['tags'], 'metadata': kwargs['metadata']})
+			result = self._cast_result(result, output, kwargs)
+
+		return self._store_result(kwargs, prompt, full_prompt, result)
+
+	# Same as invoke, but awaits the model so many invocations can run concurrently on one event loop, e.g. with asyncio.gather()
+	async def ainvoke(self, prompt:str=None, rate_limiter=None, llm_pool=None, **kwargs):
+		kwargs, prompt, prompt_args, full_prompt, output = self._prepare_invocation(prompt, kwargs)
+
+		# Caching
+		cached_result = self._cached_result(kwargs, full_prompt, output)
+		if cached_result is not CACHE_MISS:
+			return cached_result
+
+		# Only actual requests count towards the rate limits, cache hits are free
+		if rate_limiter is not None:
+			await rate_limiter.acquire(estimate_tokens(full_prompt))
+
+		image_generation, raw = image_output_mode(output)
+		if image_generation:
+			result = await asyncio.to_thread(self.generate_image, prompt, raw)
+		else:
+			ai_chain = self._build_chain(prompt, full_prompt, output, kwargs, llm_pool or _get_loop_llm_pool())
+			result = await ai_chain.ainvoke(prompt_args, {'tags': kwargs['tags'], 'metadata': kwargs['metadata']})
+			result = self._cast_result(result, output, kwargs)
+
+		return self._store_result(kwargs, prompt, full_prompt, result)
+
+	# Fills in the defaults and builds the prompt that will actually be sent to the model
+	def _prepare_invocation(self, prompt, kwargs):
 		# The invoke method accepts keyword arguments and ensures all keys in self.variables have a value, using default values from self.variables if not provided.
 		for key in self.variables:
 			if key not in kwargs or kwargs[key] is None:
@@ -155,113 +235,233 @@ class AI:
 
 		
 		# Preparing parameters and placing them into the prompt
-		prompt_args = deepcopy(kwargs['params'])
+		# Only a flat copy, nested values in params are shared with the caller
+		prompt_args = kwargs['params']
 		if isinstance(prompt_args, AI):
 			prompt_args = prompt_args.todict()
+		else:
+			prompt_args = dict(prompt_args)
 		prompt = replace_placeholders(prompt, prompt_args, kwargs['param_default'])
 
 		if kwargs['append_history']:
-			chat_history = ""
-			for i in range(len(self.chat)):
-				chat_history += f"""
-{kwargs['history_names'][0]}: {self.chat[i][0]['prompt']}
-{kwargs['history_names'][1]}: {self.chat[i][1]}"""
-			chat_history = chat_history.strip()
+			chat_history = self.history.strip()
 			full_prompt = chat_history + "\n" + f"{kwargs['history_names'][0]}: " + prompt
 			full_prompt += "\n" + f"{kwargs['history_names'][1]}: "
 		else:
 			full_prompt = prompt
 
-		# Caching
-		if kwargs['caching']:
-			cached_result = self.cache_get(kwargs | {'full_prompt': full_prompt})
-			if cached_result:
-				return cached_result
+		return kwargs, prompt, prompt_args, full_prompt, output
 
-		# Setting up llm with desired temperature and model
-		llm = ChatOpenAI(temperature=kwargs['temperature'], model=kwargs['model'])
+	# Builds the langchain pipeline from prompt to parsed result for the desired output type
+	def _build_chain(self, prompt, full_prompt, output, kwargs, llm_pool=None):
+		# Setting up llm with desired temperature and model, reused between invocations. Async invocations take it from their pool.
+		if llm_pool is None:
+			llm = _get_llm(kwargs['model'], kwargs['temperature'])
+		else:
+			llm = llm_pool.get_llm(kwargs['model'], kwargs['temperature'])
 
-		ai_chain = ChatPromptTemplate.from_template(full_prompt)
+		ai_chain = self._prompt_template(prompt, full_prompt, kwargs)
 
 		# Use this anywhere in the chains to easily view the current state of the variables being passed through at that point
 		def debug_print(x):
 			print(f"\n{x}\n")
 			return(x)
 		
-		# Image generation
-		if type(output) is str and output.lower() in ['image', 'img', 'i', 'picture', 'pic', 'p']:
-			image_generation = True
-			raw = False
-		elif type(output) is str and output.lower().replace(' ', '') in ['imageraw', 'imgraw', 'iraw', 'pictureraw', 'picraw', 'praw']:
-			image_generation = True
-			raw = True
-		else:
-			image_generation = False
-		
-		if image_generation:
-			pass
-		
 		# Simple string output
-		elif output is str:
+		if output is str:
 			ai_chain |= llm
 			ai_chain |= StrOutputParser()
 		
+		# Dictionaries are requested as a plain JSON object, so the model writes {"brand": "Ferrari", ...} directly
+		elif output is dict and supports_json_mode(kwargs['model']):
+			ai_chain = ChatPromptTemplate.from_messages([SystemMessage(content=DICT_OUTPUT_INSTRUCTION)]) + ai_chain
+			ai_chain |= llm.bind(response_format={"type": "json_object"})
+			ai_chain |= JsonOutputParser()
+
+		# Numbers and booleans are short plain text answers, that's cheaper and faster than a function call
+		elif output is int:
+			ai_chain = ChatPromptTemplate.from_messages([SystemMessage(content=INT_OUTPUT_INSTRUCTION)]) + ai_chain
+			ai_chain |= llm
+			ai_chain |= StrOutputParser()
+			ai_chain |= parse_int
+		elif output is float:
+			ai_chain = ChatPromptTemplate.from_messages([SystemMessage(content=NUMBER_OUTPUT_INSTRUCTION)]) + ai_chain
+			ai_chain |= llm
+			ai_chain |= StrOutputParser()
+			ai_chain |= parse_number
+		elif output is bool:
+			ai_chain = ChatPromptTemplate.from_messages([SystemMessage(content=BOOL_OUTPUT_INSTRUCTION)]) + ai_chain
+			ai_chain |= llm
+			ai_chain |= StrOutputParser()
+			ai_chain |= parse_bool
+
 		# Any other output type, formatted as OpenAI function call
 		elif type(output) is type:
-			response_description = ''
-			# response_description = prompt # Disabled because it would just appear twice
-			if output == int:
-				response_format = function_int("") # Your response as an integer number")
-			elif output == float:
-				response_format = function_float("")
-			elif output == bool:
-				response_format = function_bool("")
-			elif output == list:
-				response_format = function_array("", function_str(""))
-			elif output == dict:
-				response_description = "An object that defines its own list of properties."
-				response_format = function_array("", function_object({
-					"key": function_str(""),
-					"value": function_str(""),
-				}, ["key", "value"]))
-			else:
-				raise NotImplementedError(f"Output type {output} is not implemented yet.")
-
-			output_structure = create_function_call(
-				"Response",
-				response_description,
-				function_object({
-					"response": response_format,
-				}, ["response"]),
-			)
+			output_structure, output_parser = _get_output_schema(output)
 			ai_chain |= llm_with_function_call(llm, output_structure)
-			ai_chain |= JsonOutputFunctionsParser()
-			ai_chain |= (lambda x: x['response'])
-
-			if output == dict:
-				ai_chain |= (lambda dict_list: {item['key']: item['value'] for item in dict_list})
+			ai_chain |= output_parser
 
 		# Fallback:
 		else:
 			raise ValueError(f"Output type {output} is invalid. Please define a valid output type")
 
-		if image_generation:
-			result = self.generate_image(prompt, raw)
-		else:
-			result = ai_chain.invoke(prompt_args, {'tags': kwargs['tags'], 'metadata': kwargs['metadata']})
+		return ai_chain
 
-			if 'cast_to_preffered_type' in kwargs and kwargs['cast_to_preffered_type']:
-				result = output(result)
-			if not 'cast_to_preffered_type' in kwargs and AUTO_CAST_TO_PREFERRED_TYPE:
-				result = output(result)
+	# Looks up an answer this instance already gave for the settings, CACHE_MISS if there is none
+	def _previous_result(self, kwargs):
+		if not self.results:
+			return CACHE_MISS
+		kwargs, _, _, full_prompt, _ = self._prepare_invocation(None, dict(kwargs))
+		# Without caching, every result is a fresh invocation
+		if not kwargs['caching']:
+			return CACHE_MISS
+		return self.results.get(_cache_key(kwargs | {'full_prompt': full_prompt}), CACHE_MISS)
+
+	# With history, the conversation is sent as separate messages behind a fixed system message.
+	# Earlier turns then stay byte-identical between calls, so the provider can reuse its prompt cache for them.
+	def _prompt_template(self, prompt, full_prompt, kwargs):
+		if not kwargs['append_history']:
+			return ChatPromptTemplate.from_template(full_prompt)
+
+		question_name, answer_name = kwargs['history_names']
+		messages = [SystemMessage(content=f"Continue the following conversation of {question_name} and {answer_name} turns. You are giving the {answer_name}.")]
+		messages += self.history_messages
+		messages.append(("human", prompt))
+		return ChatPromptTemplate.from_messages(messages)
+
+	# Looks up the result in the cache and casts it like a fresh one, CACHE_MISS if it is not cached
+	def _cached_result(self, kwargs, full_prompt, output):
+		if not kwargs['caching']:
+			return CACHE_MISS
+		cached_result = self.cache_get(kwargs | {'full_prompt': full_prompt}, CACHE_MISS)
+		if cached_result is CACHE_MISS or image_output_mode(output)[0]:
+			return cached_result
+		return self._cast_result(cached_result, output, kwargs)
+
+	def _cast_result(self, result, output, kwargs):
+		if 'cast_to_preffered_type' in kwargs and kwargs['cast_to_preffered_type']:
+			result = output(result)
+		if not 'cast_to_preffered_type' in kwargs and AUTO_CAST_TO_PREFERRED_TYPE:
+			result = output(result)
+		return result
 
-		# Store in instance-history and in cache
-		self.results.append((deepcopy(kwargs) | {'full_prompt': full_prompt}, result))
-		self.chat.append((deepcopy(kwargs) | {'prompt': prompt}, result))
+	# Store in instance-history and in cache
+	# The stored settings are shallow copies, so don't mutate objects you passed in (e.g. nested values of params) afterwards
+	def _store_result(self, kwargs, prompt, full_prompt, result):
+		self.results[_cache_key(kwargs | {'full_prompt': full_prompt})] = result
+		self.chat.append(({**kwargs, 'prompt': prompt}, result))
+		if kwargs['append_history']:
+			self.history += f"""
+{kwargs['history_names'][0]}: {prompt}
+{kwargs['history_names'][1]}: {result}"""
+			self.history_messages += [HumanMessage(content=prompt), AIMessage(content=str(result))]
 		if kwargs['caching']:
 			self.cache_set(kwargs | {'full_prompt': full_prompt}, result)
 		return(result)
 
+	# Runs a prompt template for every item of a list concurrently. Use {lambda} in the template as placeholder for the item.
+	# The template can be a string or another AI() instance, whose settings will then be used for every item.
+	# Up to batch_size items are packed into a single request to save on the repeated prompt, use batch_size=1 to ask for each item separately.
+	def map(self, input_list:list=None, prompt_template=None, max_concurrent:int=MAX_CONCURRENT_REQUESTS, batch_size:int=MAP_BATCH_SIZE, **kwargs):
+		run_map = lambda: asyncio.run(self.amap(input_list, prompt_template, max_concurrent, batch_size, **kwargs))
+		try:
+			asyncio.get_running_loop()
+		except RuntimeError:
+			return run_map()
+		# Inside a running event loop (e.g. Jupyter or an async web handler) asyncio.run() is not allowed, so the map gets its own loop in a worker thread
+		with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+			return executor.submit(run_map).result()
+
+	# Same as map, for use inside an already running event loop
+	async def amap(self, input_list:list=None, prompt_template=None, max_concurrent:int=MAX_CONCURRENT_REQUESTS, batch_size:int=MAP_BATCH_SIZE, **kwargs):
+		if input_list is None:
+			input_list = self.variables['input_list']
+		if input_list is None:
+			raise ValueError("No input_list was given for mapping the AI over.")
+		if prompt_template is None:
+			prompt_template = self.variables['batch']
+		if prompt_template is None:
+			raise ValueError("No prompt template was given for mapping the AI over, please use the batch parameter or pass one.")
+		if not isinstance(prompt_template, AI):
+			# Only the settings are inherited, each item gets its own (str by default) answer without the chat history
+			prompt_template = AI(**self.variables | {'prompt': prompt_template, 'output': None, 'append_history': False, 'batch': None, 'input_list': None})
+
+		# All requests of this map share one async connection pool, which is closed afterwards
+		async with AsyncLLMPool() as llm_pool:
+			return await self._map_async(list(input_list), prompt_template, max_concurrent, batch_size, llm_pool, kwargs)
+
+	async def _map_async(self, input_list, template, max_concurrent, batch_size, llm_pool, kwargs):
+		semaphore = asyncio.Semaphore(max_concurrent)
+		rate_limiter = RateLimiter(MAX_REQUESTS_PER_MINUTE, MAX_TOKENS_PER_MINUTE)
+
+		params = template.variables['params']
+		if isinstance(params, AI):
+			params = params.todict()
+
+		item_ais = [AI(**template.variables | kwargs | {'params': dict(params) | {'lambda': item}}) for item in input_list]
+
+		async def invoke_item(item_ai):
+			async with semaphore:
+				return await item_ai.ainvoke(rate_limiter=rate_limiter, llm_pool=llm_pool)
+
+		output = kwargs.get('output') or template.variables['output'] or str
+		if batch_size <= 1 or output not in PACKABLE_OUTPUT_TYPES:
+			return await asyncio.gather(*[invoke_item(item_ai) for item_ai in item_ais])
+
+		# Only the items that are not cached yet get packed into requests
+		results = [None] * len(item_ais)
+		prepared = [None] * len(item_ais)
+		pending = []
+		for i, item_ai in enumerate(item_ais):
+			prepared[i] = item_ai._prepare_invocation(None, {})
+			item_kwargs, _, _, full_prompt, item_output = prepared[i]
+			cached_result = item_ai._cached_result(item_kwargs, full_prompt, item_output)
+			if cached_result is not CACHE_MISS:
+				results[i] = cached_result
+			else:
+				pending.append(i)
+
+		packed_ai = AI(**template.variables | kwargs | {'params': dict(params) | {'lambda': PACKED_ITEM_PLACEHOLDER}, 'append_history': False})
+
+		async def invoke_chunk(chunk):
+			async with semaphore:
+				answers = await packed_ai._async_invoke_packed([input_list[i] for i in chunk], rate_limiter=rate_limiter, llm_pool=llm_pool)
+			for i, answer in zip(chunk, answers):
+				if answer is MISSING_RESPONSE:
+					# The model skipped this item, so it gets asked on its own
+					results[i] = await invoke_item(item_ais[i])
+				else:
+					item_kwargs, prompt, _, full_prompt, _ = prepared[i]
+					results[i] = item_ais[i]._store_result(item_kwargs, prompt, full_prompt, answer)
+
+		chunks = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+		await asyncio.gather(*[invoke_chunk(chunk) for chunk in chunks])
+		return results
+
+	# Asks the (placeholder) prompt for several items in one request and returns the answers in the order of the items
+	async def _async_invoke_packed(self, items:list, rate_limiter=None, llm_pool=None, **kwargs):
+		kwargs, prompt, prompt_args, _, output = self._prepare_invocation(None, kwargs)
+
+		full_prompt = f"Answer the following prompt separately for each of the numbered items below, with {PACKED_ITEM_PLACEHOLDER} standing for the item. Respond with the number of each item as its index.\n\n"
+		full_prompt += f"Prompt: {prompt}\n\nItems:\n"
+		full_prompt += "\n".join(f"{index}. {item}" for index, item in enumerate(items, start=1))
+
+		if rate_limiter is not None:
+			await rate_limiter.acquire(estimate_tokens(full_prompt))
+
+		llm = (llm_pool or _get_loop_llm_pool()).get_llm(kwargs['model'], kwargs['temperature'])
+		output_structure, output_parser = _get_packed_output_schema(output)
+
+		ai_chain = ChatPromptTemplate.from_template(full_prompt)
+		ai_chain |= llm_with_function_call(llm, output_structure)
+		ai_chain |= output_parser
+
+		responses = await ai_chain.ainvoke(prompt_args, {'tags': kwargs['tags'], 'metadata': kwargs['metadata']})
+		answers = unpack_indexed_responses(responses, len(items))
+		if output is int:
+			# Round like single int answers instead of truncating in the cast
+			answers = [round(answer) if type(answer) is float else parse_int(answer) if type(answer) is str else answer for answer in answers]
+		return [answer if answer is MISSING_RESPONSE else self._cast_result(answer, output, kwargs) for answer in answers]
 
 
 
@@ -276,14 +476,30 @@ class AI:
 		if preferred_type is None:
 			preferred_type = str
 			cast_to_preferred_type = False
-		if self.results and self.results[-1][0] == self.variables:
-			result = self.results[-1][1]
-		elif not self.variables['prompt']:
-				raise ValueError("No prompt was given for the AI invocation. Cannot get the result of AI() without prompt")
-		elif self.variables['output'] is None:
-			result = self.invoke(output=preferred_type)
-		else:
-			result = self.invoke()
+		if not self.variables['prompt']:
+			raise ValueError("No prompt was given for the AI invocation. Cannot get the result of AI() without prompt")
+
+		invoke_kwargs = {'output': preferred_type} if self.variables['output'] is None else {}
+		# Any earlier answer to the same settings is reused, not just the last one
+		result = self._previous_result(invoke_kwargs)
+		if result is CACHE_MISS:
+			result = self.invoke(**invoke_kwargs)
+		if cast_to_preferred_type and preferred_type is not None:
+			result = preferred_type(result)
+		return result
+
+	# Same as result, but awaitable: await asyncio.gather(*[population_of(c).aresult(int) for c in countries])
+	async def aresult(self, preferred_type:type=None, cast_to_preferred_type=True):
+		if preferred_type is None:
+			preferred_type = str
+			cast_to_preferred_type = False
+		if not self.variables['prompt']:
+			raise ValueError("No prompt was given for the AI invocation. Cannot get the result of AI() without prompt")
+
+		invoke_kwargs = {'output': preferred_type} if self.variables['output'] is None else {}
+		result = self._previous_result(invoke_kwargs)
+		if result is CACHE_MISS:
+			result = await self.ainvoke(**invoke_kwargs)
 		if cast_to_preferred_type and preferred_type is not None:
 			result = preferred_type(result)
 		return result
@@ -303,8 +519,19 @@ class AI:
 			return self.__float__()
 
 	def __iter__(self):
+		# With a batch template, every list item gets passed through it concurrently
+		if self.variables['batch'] is not None:
+			return self.map(self.result(list)).__iter__()
 		return self.result(list).__iter__()
 
+	# async for item in AI(...), the batch template is applied the same way as in __iter__
+	async def __aiter__(self):
+		items = await self.aresult(list)
+		if self.variables['batch'] is not None:
+			items = await self.amap(items)
+		for item in items:
+			yield item
+
 	def tostr(self, **kwargs):
 		if type(self) is str:
 			self = AI(**kwargs | {'prompt': self})
@@ -411,43 +638,73 @@ class AI:
 				self.cache = {}
 		elif self.variables['cache_location'].lower() == 'session':
 			global cache
-			if not 'cache' in globals():
-				cache = {}
+			with cache_lock:
+				if not 'cache' in globals():
+					cache = collections.OrderedDict()
+		elif self.variables['cache_location'].lower() == 'semantic':
+			global semantic_cache
+			if semantic_cache is None:
+				semantic_cache = SemanticCache()
 		else:
-			raise NotImplementedError(f"Cache location {self.variables['cache_location']} is not implemented yet.")
+			path = disk_cache_path(self.variables['cache_location'])
+			if path not in disk_caches:
+				disk_caches[path] = open_disk_cache(path)
 
-	def cache_get(self, key):
+	# Returns default if nothing is cached, pass a sentinel like CACHE_MISS to tell falsy cached results (0, False, "", []) apart
+	def cache_get(self, key, default=False):
 		if not self.variables['caching'] or self.variables['cache_location'].lower() == 'none':
-			return False
+			return default
 		elif self.variables['cache_location'].lower() == 'instance':
-			return self.cache.get(str(key), False)
+			return self.cache.get(_cache_key(key), default)
 		elif self.variables['cache_location'].lower() == 'session':
 			global cache
-			return cache.get(str(key), False)
+			cache_key = _cache_key(key)
+			with cache_lock:
+				if cache_key not in cache:
+					return default
+				cache.move_to_end(cache_key)
+				return cache[cache_key]
+		elif self.variables['cache_location'].lower() == 'semantic':
+			return semantic_cache.get(key, default)
 		else:
-			raise NotImplementedError(f"Cache location {self.variables['cache_location']} is not implemented yet.")
+			row = self.disk_cache().execute("SELECT v FROM cache WHERE k=? AND typeof(v)='text'", (_cache_key(key),)).fetchone()
+			return decode_cache_value(row[0]) if row else default
 
 	def is_cached(self, key):
 		if not self.variables['caching'] or self.variables['cache_location'].lower() == 'none':
 			return False
 		elif self.variables['cache_location'].lower() == 'instance':
-			return str(key) in self.cache
+			return _cache_key(key) in self.cache
 		elif self.variables['cache_location'].lower() == 'session':
 			global cache
-			return str(key) in cache
+			cache_key = _cache_key(key)
+			with cache_lock:
+				return cache_key in cache
+		elif self.variables['cache_location'].lower() == 'semantic':
+			return semantic_cache.get(key, CACHE_MISS) is not CACHE_MISS
 		else:
-			raise NotImplementedError(f"Cache location {self.variables['cache_location']} is not implemented yet.")
+			return self.disk_cache().execute("SELECT 1 FROM cache WHERE k=? AND typeof(v)='text'", (_cache_key(key),)).fetchone() is not None
 	
 	def cache_set(self, key, value):
 		if not self.variables['caching'] or self.variables['cache_location'].lower() == 'none':
 			return False
 		elif self.variables['cache_location'].lower() == 'instance':
-			self.cache[str(key)] = value
+			self.cache[_cache_key(key)] = value
 		elif self.variables['cache_location'].lower() == 'session':
 			global cache
-			cache[str(key)] = value
+			cache_key = _cache_key(key)
+			with cache_lock:
+				cache[cache_key] = value
+				cache.move_to_end(cache_key)
+				# Least recently used answers are dropped first
+				while len(cache) > SESSION_CACHE_MAXSIZE:
+					cache.popitem(last=False)
+		elif self.variables['cache_location'].lower() == 'semantic':
+			semantic_cache.set(key, value)
 		else:
-			raise NotImplementedError(f"Cache location {self.variables['cache_location']} is not implemented yet.")
+			encoded = encode_cache_value(value)
+			if encoded is not None:
+				self.disk_cache().execute("INSERT OR REPLACE INTO cache (k, v, ts) VALUES (?, ?, ?)", (_cache_key(key), encoded, int(time.time())))
 
 	def retrieve_whole_cache(self):
 		if not self.variables['caching'] or self.variables['cache_location'].lower() == 'none':
@@ -456,9 +713,212 @@ class AI:
 			return self.cache
 		elif self.variables['cache_location'].lower() == 'session':
 			global cache
-			return cache
+			# A snapshot, so other threads can keep using the cache while it is being read
+			with cache_lock:
+				return dict(cache)
+		elif self.variables['cache_location'].lower() == 'semantic':
+			with cache_lock:
+				return dict(semantic_cache.exact)
 		else:
-			raise NotImplementedError(f"Cache location {self.variables['cache_location']} is not implemented yet.")
+			return {k: decode_cache_value(v) for k, v in self.disk_cache().execute("SELECT k, v FROM cache WHERE typeof(v)='text'")}
+
+	# The sqlite connection backing the project, module or filesystem path cache
+	def disk_cache(self):
+		path = disk_cache_path(self.variables['cache_location'])
+		if path not in disk_caches:
+			disk_caches[path] = open_disk_cache(path)
+		return disk_caches[path]
+
+class SemanticCache:
+	"""
+	Session cache that also returns answers of paraphrased prompts, e.g. "population of India" and "India's population".
+	Prompts are embedded locally, so a lookup takes milliseconds instead of another AI call.
+	"""
+	def __init__(self, model_name:str=SEMANTIC_CACHE_MODEL, similarity:float=SEMANTIC_CACHE_SIMILARITY):
+		try:
+			import numpy
+			from sentence_transformers import SentenceTransformer
+		except ImportError as e:
+			raise ImportError("The semantic cache needs the sentence-transformers and numpy packages, please install them first.") from e
+		self.numpy = numpy
+		self.model = SentenceTransformer(model_name)
+		self.similarity = similarity
+		self.exact = {} # Exact matches by cache key, as in the session cache
+		self.embeddings = numpy.zeros((SEMANTIC_CACHE_BLOCK_SIZE, self.model.get_sentence_embedding_dimension()), dtype=numpy.float32) # Grown in blocks, only the first len(self.entries) rows are used
+		self.entries = [] # (settings, value) per used row of self.embeddings
+
+	# Everything besides the prompt has to match exactly
+	def _settings(self, kwargs):
+		output = kwargs.get('output') or str
+		return (kwargs.get('model'), kwargs.get('temperature'), getattr(output, '__name__', output), kwargs.get('provider'))
+
+	def _embed(self, text:str):
+		return self.model.encode([text], normalize_embeddings=True).astype(self.numpy.float32)[0]
+
+	# Only answers of low temperatures are ever looked up by similarity, so only those get embedded
+	def _is_semantic(self, kwargs):
+		temperature = kwargs.get('temperature')
+		return temperature is not None and temperature <= SEMANTIC_CACHE_MAX_TEMPERATURE
+
+	def get(self, kwargs, default=None):
+		key = _cache_key(kwargs)
+		with cache_lock:
+			if key in self.exact:
+				return self.exact[key]
+			if not self.entries or not self._is_semantic(kwargs):
+				return default
+
+		# Embedding is slow, so it happens outside of the lock
+		query = self._embed(kwargs['full_prompt'])
+		settings = self._settings(kwargs)
+		with cache_lock:
+			# Embeddings are normalized, so the dot product is the cosine similarity
+			similarities = self.embeddings[:len(self.entries)] @ query
+			for index in self.numpy.argsort(-similarities):
+				if similarities[index] < self.similarity:
+					break
+				if self.entries[index][0] == settings:
+					return self.entries[index][1]
+		return default
+
+	def set(self, kwargs, value):
+		key = _cache_key(kwargs)
+		if not self._is_semantic(kwargs):
+			with cache_lock:
+				self.exact[key] = value
+			return
+
+		embedding = self._embed(kwargs['full_prompt'])
+		with cache_lock:
+			self.exact[key] = value
+			if len(self.entries) == len(self.embeddings):
+				self.embeddings = self.numpy.concatenate([self.embeddings, self.numpy.zeros_like(self.embeddings)])
+			self.embeddings[len(self.entries)] = embedding
+			self.entries.append((self._settings(kwargs), value))
+
+def disk_cache_path(cache_location:str):
+	"""
+	Resolve the sqlite file used for a disk cache location.
+
+	:param cache_location: 'project', 'module' or a filesystem path (file or existing folder).
+	:return: Absolute path of the sqlite cache file.
+	"""
+	if cache_location.lower() == 'project':
+		path = os.path.join(os.getcwd(), DISK_CACHE_FILENAME)
+	elif cache_location.lower() == 'module':
+		path = os.path.join(sys.prefix, DISK_CACHE_FILENAME)
+	elif os.path.isdir(cache_location):
+		path = os.path.join(cache_location, DISK_CACHE_FILENAME)
+	else:
+		path = cache_location
+	return os.path.abspath(os.path.expanduser(path))
+
+def open_disk_cache(path:str):
+	connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+	connection.execute("PRAGMA journal_mode=WAL")
+	connection.execute("PRAGMA synchronous=NORMAL")
+	connection.execute("CREATE TABLE IF NOT EXISTS cache (k TEXT PRIMARY KEY, v BLOB, ts INTEGER)")
+	return connection
+
+# Values are only stored as JSON text. Disk caches may be shared, so nothing is ever unpickled from them.
+# Returns None for values that don't survive a JSON round trip, those are not cached on disk.
+def encode_cache_value(value):
+	try:
+		encoded = json.dumps(value)
+	except (TypeError, ValueError):
+		return None
+	return encoded if json.loads(encoded) == value else None
+
+def decode_cache_value(stored):
+	return json.loads(stored)
+
+def _cache_key(kwargs):
+	"""
+	Create a stable cache key from the invocation settings that influence the result.
+
+	:param kwargs: The invocation settings, including the 'full_prompt' that is sent to the model.
+	:return: SHA-256 hex digest, identical across processes for identical requests.
+	"""
+	output = kwargs.get('output') or str
+	params = kwargs.get('params')
+	relevant = {
+		'model': kwargs.get('model'),
+		'temperature': kwargs.get('temperature'),
+		'full_prompt': kwargs.get('full_prompt'),
+		'output': getattr(output, '__name__', output),
+		'provider': kwargs.get('provider'),
+		# AI() instances as params are already resolved into the full_prompt, and str() would invoke them
+		'params': params if isinstance(params, dict) else None,
+	}
+	return hashlib.sha256(json.dumps(relevant, sort_keys=True, default=str).encode()).hexdigest()
+
+# The llm and output schemas only depend on these settings, so they are built once and shared by all invocations.
+# The returned objects are shared, don't mutate them.
+@functools.lru_cache(maxsize=32)
+def _get_llm(model:str, temperature:float):
+	from langchain_openai import ChatOpenAI
+	return ChatOpenAI(temperature=temperature, model=model, http_client=_get_http_client())
+
+# One connection pool per process, so consecutive calls skip the TCP and TLS handshakes
+@functools.lru_cache(maxsize=1)
+def _get_http_client():
+	return httpx.Client(limits=HTTP_LIMITS, http2=HTTP2_AVAILABLE)
+
+class AsyncLLMPool:
+	"""
+	One async connection pool and the llms using it. Async connections belong to the event loop they were opened on,
+	so a pool must only be used on one loop, e.g. for one AI.map() call (use it with async with to close it afterwards).
+	"""
+	def __init__(self):
+		self.http_client = httpx.AsyncClient(limits=HTTP_LIMITS, http2=HTTP2_AVAILABLE)
+		self.llms = {}
+
+	def get_llm(self, model:str, temperature:float):
+		from langchain_openai import ChatOpenAI
+		if (model, temperature) not in self.llms:
+			self.llms[(model, temperature)] = ChatOpenAI(temperature=temperature, model=model, http_client=_get_http_client(), http_async_client=self.http_client)
+		return self.llms[(model, temperature)]
+
+	async def __aenter__(self):
+		return self
+
+	async def __aexit__(self, *exc_info):
+		await self.http_client.aclose()
+
+# Pools for ainvoke() calls outside of AI.map(), one per event loop. They are dropped together with their loop.
+loop_llm_pools = weakref.WeakKeyDictionary()
+
+def _get_loop_llm_pool():
+	loop = asyncio.get_running_loop()
+	if loop not in loop_llm_pools:
+		loop_llm_pools[loop] = AsyncLLMPool()
+	return loop_llm_pools[loop]
+
+@functools.lru_cache(maxsize=32)
+def _get_output_schema(output:type):
+	response_description, response_format = response_format_for(output)
+	output_structure = create_function_call(
+		"Response",
+		response_description,
+		function_object({
+			"response": response_format,
+		}, ["response"]),
+	)
+	output_parser = JsonOutputFunctionsParser() | (lambda x: x['response'])
+	return output_structure, output_parser
+
+@functools.lru_cache(maxsize=32)
+def _get_packed_output_schema(output:type):
+	_, response_format = response_format_for(output)
+	output_structure = create_function_call(
+		"Responses",
+		"",
+		function_object({
+			"responses": function_indexed_array("One response per item.", response_format),
+		}, ["responses"]),
+	)
+	output_parser = JsonOutputFunctionsParser() | (lambda x: x['responses'])
+	return output_structure, output_parser
 
 # Helper functions to easily create OpenAI function call definitions
 def llm_with_function_call(llm, function_structure: dict):
@@ -487,6 +947,13 @@ def function_type(type_name:str, description:str):
 def function_array(description:str, items: dict):
 	return function_type('array', description) | {'items': items}
 
+# Array of {index, value} objects, so several answers can be returned in one function call
+def function_indexed_array(description:str, value: dict):
+	return function_array(description, function_object({
+		"index": function_int(""),
+		"value": value,
+	}, ["index", "value"]))
+
 def function_str(description:str):
 	return function_type('string', description)
 
@@ -499,6 +966,142 @@ def function_float(description:str):
 def function_bool(description:str):
 	return function_type('boolean', description)
 
+def response_format_for(output:type):
+	"""
+	Get the function call definition of a single response value for the desired output type.
+
+	:param output: The desired output type of the AI invocation.
+	:return: Tuple (response_description, response_format).
+	"""
+	response_description = ''
+	# response_description = prompt # Disabled because it would just appear twice
+	if output == str:
+		response_format = function_str("")
+	elif output == int:
+		response_format = function_int("") # Your response as an integer number")
+	elif output == float:
+		response_format = function_float("")
+	elif output == bool:
+		response_format = function_bool("")
+	elif output == list:
+		response_format = function_array("", function_str(""))
+	elif output == dict:
+		# Only used for models without JSON mode
+		response_description = "An object that defines its own list of properties."
+		response_format = function_type('object', "")
+	else:
+		raise NotImplementedError(f"Output type {output} is not implemented yet.")
+	return response_description, response_format
+
+def supports_json_mode(model:str):
+	"""
+	Check whether the model can be called with response_format json_object.
+
+	:param model: The model name.
+	:return: False for the older models known to lack JSON mode, True otherwise.
+	"""
+	return model not in MODELS_WITHOUT_JSON_MODE
+
+def unpack_indexed_responses(responses:list, count:int):
+	"""
+	Reorder the responses of a packed request by their index.
+
+	:param responses: List of {'index': int, 'value': ...} as returned by the model, indices starting at 1.
+	:param count: Number of items that were packed into the request.
+	:return: List of values in item order, MISSING_RESPONSE for items the model did not answer.
+	"""
+	values = [MISSING_RESPONSE] * count
+	for response in responses:
+		index = response.get('index')
+		# A null value is no answer either, so the item gets asked again on its own
+		if type(index) is int and 1 <= index <= count and response.get('value') is not None:
+			values[index - 1] = response['value']
+	return values
+
+def image_output_mode(output):
+	"""
+	Check whether the output type asks for image generation.
+
+	:param output: The desired output type of the AI invocation.
+	:return: Tuple (image_generation, raw), raw disables the automatic prompt enhancement.
+	"""
+	if type(output) is str and output.lower() in ['image', 'img', 'i', 'picture', 'pic', 'p']:
+		return True, False
+	elif type(output) is str and output.lower().replace(' ', '') in ['imageraw', 'imgraw', 'iraw', 'pictureraw', 'picraw', 'praw']:
+		return True, True
+	return False, False
+
+def estimate_tokens(text):
+	# Rough estimate of ~4 characters per token, good enough for rate limiting
+	return len(text) // 4 + 1
+
+class RateLimiter:
+	"""
+	Token bucket limiting requests and tokens per minute, shared by all concurrent requests of one AI.map() call.
+	"""
+	def __init__(self, requests_per_minute:int, tokens_per_minute:int):
+		self.requests_per_minute = requests_per_minute
+		self.tokens_per_minute = tokens_per_minute
+		self.available_requests = requests_per_minute
+		self.available_tokens = tokens_per_minute
+		self.last_update = time.monotonic()
+
+	def _refill(self):
+		now = time.monotonic()
+		elapsed = now - self.last_update
+		self.last_update = now
+		self.available_requests = min(self.requests_per_minute, self.available_requests + self.requests_per_minute * elapsed / 60)
+		self.available_tokens = min(self.tokens_per_minute, self.available_tokens + self.tokens_per_minute * elapsed / 60)
+
+	async def acquire(self, tokens:int=1):
+		tokens = min(tokens, self.tokens_per_minute)
+		while True:
+			self._refill()
+			if self.available_requests >= 1 and self.available_tokens >= tokens:
+				self.available_requests -= 1
+				self.available_tokens -= tokens
+				return
+			# Wait until enough capacity for this request has been refilled
+			missing_requests = max(0, 1 - self.available_requests) / self.requests_per_minute
+			missing_tokens = max(0, tokens - self.available_tokens) / self.tokens_per_minute
+			await asyncio.sleep(max(missing_requests, missing_tokens) * 60)
+
+def parse_number(text:str):
+	"""
+	Read the number from a plain text answer.
+
+	:param text: The answer of the model, ideally only the number.
+	:return: The first number in the text, as int if it is written without decimals or exponent (so large numbers stay exact), else as float.
+	"""
+	text = THOUSANDS_SEPARATOR_PATTERN.sub('', text)
+	text = DECIMAL_COMMA_PATTERN.sub('.', text)
+	match = NUMBER_PATTERN.search(text)
+	if match is None:
+		raise ValueError(f"The answer '{text}' does not contain a number.")
+	number = match.group()
+	if any(character in number for character in '.eE'):
+		return float(number)
+	return int(number)
+
+def parse_int(text:str):
+	"""
+	Read a whole number from a plain text answer.
+
+	:param text: The answer of the model, ideally only the number.
+	:return: The first number in the text, rounded to the nearest int.
+	"""
+	number = parse_number(text)
+	return number if type(number) is int else round(number)
+
+def parse_bool(text:str):
+	"""
+	Read yes or no from a plain text answer.
+
+	:param text: The answer of the model, ideally only 'yes' or 'no'.
+	:return: True for yes (or true), False otherwise.
+	"""
+	return text.strip().lower().startswith(('y', 'true'))
+
 def replace_placeholders(text, replacements, default=None):
 	"""
 	Replace placeholders in the text with corresponding values from replacements dictionary.
@@ -507,16 +1110,14 @@ def replace_placeholders(text, replacements, default=None):
 	:param replacements: A dictionary where keys are placeholder names and values are replacement values.
 	:return: Text with placeholders replaced by their corresponding values.
 	"""
-	# Find all placeholders in the text
-	placeholders = re.findall(r'\{(.*?)\}', text)
-
-	# Replace each placeholder with the corresponding value from the replacements dictionary
-	for placeholder in placeholders:
+	# Replace each placeholder with the corresponding value from the replacements dictionary, in a single pass over the text
+	def replacement(match):
+		placeholder = match.group(1)
 		if placeholder in replacements:
-			text = text.replace('{' + placeholder + '}', str(replacements[placeholder]))
+			return str(replacements[placeholder])
 		elif default is not None:
-			text = text.replace('{' + placeholder + '}', default)
+			return default
 		else:
 			raise KeyError(f"Placeholder {placeholder} was not found in replacements dictionary.")
 
-	return text
+	return PLACEHOLDER_PATTERN.sub(replacement, text)